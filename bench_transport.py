@@ -0,0 +1,96 @@
+"""
+Бенчмарк HTTP-транспорта: пропускная способность рассылки в зависимости от размера пула.
+
+Поднимает локальный «фальшивый» Bot API (отвечает на любой метод с задержкой,
+как настоящий сервер Telegram) и шлёт через него sendMessage тем же клиентом,
+что и бот (main.build_request).
+
+Запуск:
+    python bench_transport.py [--messages 500] [--latency 0.05] [--pools 1,4,16,64]
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+
+from threading import Thread
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+os.environ.setdefault("token_on", "123456:BENCHMARK")
+
+import main  # noqa: E402
+from telegram import Bot  # noqa: E402
+
+
+def make_handler(latency: float):
+    """HTTP-хендлер фальшивого Bot API с заданной задержкой ответа."""
+
+    class FakeBotAPI(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, как у api.telegram.org
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            method = self.path.rsplit("/", 1)[-1]
+            time.sleep(latency)
+
+            if method == "getMe":
+                result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            else:
+                result = {
+                    "message_id": 1,
+                    "date": int(time.time()),
+                    "chat": {"id": 1, "type": "private"},
+                    "text": "ok",
+                }
+            body = json.dumps({"ok": True, "result": result}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeBotAPI
+
+
+async def run_once(port: int, pool_size: int, messages: int) -> float:
+    """Разослать messages сообщений параллельно; вернуть сообщений в секунду."""
+    profile = dict(main.TRANSPORT, pool_size=pool_size, keepalive=pool_size, pool_timeout=60)
+    bot = Bot(
+        main.BOT_TOKEN,
+        base_url=f"http://127.0.0.1:{port}/bot",
+        request=main.build_request(profile),
+    )
+    async with bot:
+        started = time.perf_counter()
+        await asyncio.gather(*(bot.send_message(chat_id=1, text="x") for _ in range(messages)))
+        elapsed = time.perf_counter() - started
+    return messages / elapsed
+
+
+def main_bench():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.05, help="задержка ответа API, сек")
+    parser.add_argument("--pools", default="1,4,16,64,128")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(args.latency))
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    print(f"Фальшивый API на :{port}, задержка {args.latency * 1000:.0f} мс, сообщений {args.messages}")
+    print(f"{'пул':>6} {'сообщ/с':>10}")
+    for pool_size in (int(p) for p in args.pools.split(",")):
+        rate = asyncio.run(run_once(port, pool_size, args.messages))
+        print(f"{pool_size:>6} {rate:>10.1f}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main_bench()
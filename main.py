@@ -3,7 +3,18 @@ import logging
 import random
 import datetime
 import re
-
+import asyncio
+import time
+import functools
+import cProfile
+import json
+import sqlite3
+import gzip
+import hashlib
+
+from collections import deque
+
+import httpx
 from flask import Flask
 from threading import Thread
 
@@ -11,9 +22,13 @@ from telegram import (
     Update,
     BotCommand,
     InlineKeyboardMarkup,
-    InlineKeyboardButton
+    InlineKeyboardButton,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaDocument
 )
 from telegram.ext import (
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
@@ -22,6 +37,8 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
 
 
 # ------------------------------------------------------------------------
@@ -64,13 +81,54 @@ logging.basicConfig(
 # 4) ГЛОБАЛЬНЫЕ СТРУКТУРЫ ДАННЫХ
 # ------------------------------------------------------------------------
 users_in_chat = {}       # { user_id: {...} }
+rooms = {}               # { room_id: { user_id: {...} } } — те же записи, что в users_in_chat
+codes_index = {}         # { code.lower(): user_id } для тех, кто в чате
+recipients_cache = {}    # { (room_id, category): { user_id: (info, silent) } }
+ignored_by = {}          # { sender_id: {user_id, ...} } — кто игнорирует отправителя
+ignoring = {}            # { user_id: {sender_id, ...} } — кого игнорирует пользователь
 users_history = {}       # { user_id: {...} }
-parted_users = []        # [(nick, code, time), ...]
+parted_users = deque(maxlen=20)  # [(nick, code, time), ...], новые слева
 private_messages = {}    # { user_id: [ { from, text }, ... ] }
 user_notify_settings = {}# { user_id: {...} }
 polls = {}               # { creator_id: {...} }
-admin_ids = set()
-moderator_ids = set()
+pending_media_groups = {}# { media_group_id: { user_id, items, caption } }
+pending_presence = {}    # { (user_id, room_id): (event, code, nickname, is_new) }
+presence_state = {"scheduled": False}
+user_update_locks = {}   # { user_id: [asyncio.Lock, кол-во ожидающих] }
+admin_ids = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+moderator_ids = {int(x) for x in os.getenv("MODERATOR_IDS", "").split(",") if x.strip()}
+
+# Категории доставки: флаг в user_notify_settings, включающий звук.
+# None — без флага: chat всегда со звуком, system всегда без.
+DELIVERY_CATEGORIES = {
+    "chat": None,
+    "hug": "hug",
+    "reply": "replies",
+    "pm": "privates",
+    "system": None,
+}
+SILENT_CATEGORIES = {"system"}
+
+# Вместимость комнаты: при заполнении новые участники попадают в следующую
+ROOM_CAPACITY = int(os.getenv("ROOM_CAPACITY", "100"))
+
+# Окно, за которое входы/выходы собираются в одну сводку
+PRESENCE_WINDOW = float(os.getenv("PRESENCE_WINDOW", "10"))
+
+# Сколько секунд ждём остальные элементы альбома (media_group_id)
+MEDIA_GROUP_WINDOW = float(os.getenv("MEDIA_GROUP_WINDOW", "1.5"))
+
+MEDIA_LABELS = {
+    "photo": "фото",
+    "video": "видео",
+    "voice": "голосовое",
+    "document": "файл",
+}
+MEDIA_INPUT_TYPES = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "document": InputMediaDocument,
+}
 
 
 # ------------------------------------------------------------------------
@@ -89,10 +147,11 @@ def ensure_user_in_dicts(user_id: int):
     if user_id not in private_messages:
         private_messages[user_id] = []
     if user_id not in user_notify_settings:
+        # Адресные категории по умолчанию со звуком, как было до настроек /notify
         user_notify_settings[user_id] = {
-            "privates": False,
-            "replies": False,
-            "hug": False,
+            "privates": True,
+            "replies": True,
+            "hug": True,
             "interval": 5,
         }
 
@@ -127,13 +186,87 @@ def get_moon_symbol(seconds_diff: float) -> str:
     else:
         return "🌑"
 
-def get_user_by_code(code: str):
-    """Найти user_id по коду."""
-    for u_id, data in users_in_chat.items():
-        if data["code"].lower() == code.lower():
-            return u_id
+def get_user_by_code(code: str, room: int = None):
+    """Найти user_id по коду (если задана room — только в этой комнате)."""
+    u_id = codes_index.get(code.lower())
+    if u_id is None or (room is not None and users_in_chat[u_id]["room"] != room):
+        return None
+    return u_id
+
+def pick_room(user_id: int) -> int:
+    """Прежняя комната, если там есть место; иначе первая свободная; иначе новая."""
+    prev = users_history.get(user_id, {}).get("room")
+    if prev is not None and len(rooms.get(prev, ())) < ROOM_CAPACITY:
+        return prev
+    for room_id in sorted(rooms):
+        if len(rooms[room_id]) < ROOM_CAPACITY:
+            return room_id
+    return max(rooms, default=0) + 1
+
+def join_room(user_id: int, info: dict):
+    """Добавить пользователя в чат и в индекс его комнаты."""
+    users_in_chat[user_id] = info
+    rooms.setdefault(info["room"], {})[user_id] = info
+    codes_index[info["code"].lower()] = user_id
+    invalidate_recipients(info["room"])
+
+def leave_room(user_id: int) -> dict:
+    """Убрать пользователя из чата и индексов; пустая комната удаляется."""
+    info = users_in_chat.pop(user_id)
+    members = rooms.get(info["room"], {})
+    members.pop(user_id, None)
+    if not members:
+        rooms.pop(info["room"], None)
+    codes_index.pop(info["code"].lower(), None)
+    invalidate_recipients(info["room"])
+    return info
+
+def room_roster(room: int = None) -> dict:
+    """Участники комнаты; room=None — все, кто в чате."""
+    return users_in_chat if room is None else rooms.get(room, {})
+
+def find_user_by_nickname(nickname: str, room: int):
+    """Найти user_id по нику в комнате."""
+    for uid, info in room_roster(room).items():
+        if info["nickname"] == nickname:
+            return uid
     return None
 
+def is_silent(user_id: int, category: str) -> bool:
+    """Слать ли пользователю сообщение этой категории без звука."""
+    flag = DELIVERY_CATEGORIES[category]
+    if flag is None:
+        return category in SILENT_CATEGORIES
+    return not user_notify_settings.get(user_id, {}).get(flag, True)
+
+def get_recipients(room: int, category: str) -> dict:
+    """
+    Готовый список получателей комнаты для категории: { user_id: (info, silent) }.
+    Пересобирается только после входа/выхода или смены настроек.
+    Словарь не меняется на месте — его можно обходить через await.
+    """
+    key = (room, category)
+    recipients = recipients_cache.get(key)
+    if recipients is None:
+        recipients = recipients_cache[key] = {
+            uid: (info, is_silent(uid, category)) for uid, info in room_roster(room).items()
+        }
+    return recipients
+
+def fanout(room: int, category: str, exclude_user: int = None, sender: int = None, reply_to: int = None):
+    """
+    Получатели рассылки: (recipients, user_id для отправки).
+    Исключённые и игнорирующие sender вычитаются разностью множеств, без проверки каждого.
+    """
+    recipients = get_recipients(room, category)
+    skip = ignored_by.get(sender, set()) | {exclude_user, reply_to}
+    return recipients, recipients.keys() - skip
+
+def invalidate_recipients(room: int):
+    """Сбросить списки получателей комнаты (и общий список всех в чате)."""
+    for key in [k for k in recipients_cache if k[0] == room or k[0] is None]:
+        del recipients_cache[key]
+
 def update_last_activity(user_id: int):
     """Обновить время последней активности."""
     if user_id in users_in_chat:
@@ -141,31 +274,208 @@ def update_last_activity(user_id: int):
 
 
 # Широковещательная рассылка текста
-async def broadcast_text(telegram_app, text: str, exclude_user: int = None):
-    """Рассылка текста всем, кроме exclude_user."""
-    for uid, info in users_in_chat.items():
-        if uid == exclude_user:
-            continue
+async def broadcast_text(telegram_app, text: str, exclude_user: int = None, room: int = None,
+                         category: str = "chat", reply_to: int = None, sender: int = None):
+    """
+    Рассылка текста всем в комнате room (None — всем в чате), кроме exclude_user
+    и тех, кто игнорирует sender. reply_to получает то же сообщение по категории reply.
+    """
+    recipients, targets = fanout(room, category, exclude_user, sender, reply_to)
+    for uid in targets:
+        info, silent = recipients[uid]
         try:
-            await telegram_app.bot.send_message(chat_id=info["chat_id"], text=text)
+            await telegram_app.bot.send_message(chat_id=info["chat_id"], text=text, disable_notification=silent)
         except Exception as e:
             logging.warning(f"Ошибка отправки текста {info['nickname']}: {e}")
 
+    info = room_roster(room).get(reply_to)
+    if info is not None and reply_to != exclude_user and reply_to not in ignored_by.get(sender, ()):
+        try:
+            await telegram_app.bot.send_message(
+                chat_id=info["chat_id"],
+                text=text,
+                disable_notification=is_silent(reply_to, "reply")
+            )
+        except Exception as e:
+            logging.warning(f"Ошибка отправки ответа {info['nickname']}: {e}")
+
 
-# Широковещательная рассылка фото
-async def broadcast_photo(telegram_app, photo_file_id: str, caption: str = "", exclude_user: int = None):
-    """Рассылка фото всем, кроме exclude_user."""
-    for uid, info in users_in_chat.items():
-        if uid == exclude_user:
-            continue
+# Широковещательная рассылка медиа (фото, видео, голосовые, файлы)
+async def broadcast_media(telegram_app, kind: str, file_id: str, caption: str = "", exclude_user: int = None,
+                          room: int = None, sender: int = None):
+    """Рассылка одного медиа по file_id всем в комнате room, кроме exclude_user и игнорирующих sender."""
+    send = getattr(telegram_app.bot, f"send_{kind}")
+    recipients, targets = fanout(room, "chat", exclude_user, sender)
+    for uid in targets:
+        info, silent = recipients[uid]
+        try:
+            await send(chat_id=info["chat_id"], caption=caption, disable_notification=silent, **{kind: file_id})
+        except Exception as e:
+            logging.warning(f"Ошибка отправки {kind} {info['nickname']}: {e}")
+
+
+# Широковещательная рассылка альбома
+async def broadcast_media_group(telegram_app, items: list, caption: str = "", exclude_user: int = None,
+                                room: int = None, sender: int = None):
+    """
+    Рассылка альбома одним send_media_group на получателя в комнате room.
+    items — список (kind, file_id); подпись ставится на первый элемент.
+    """
+    media = [MEDIA_INPUT_TYPES[kind](file_id) for kind, file_id in items]
+    recipients, targets = fanout(room, "chat", exclude_user, sender)
+    for uid in targets:
+        info, silent = recipients[uid]
         try:
-            await telegram_app.bot.send_photo(
+            await telegram_app.bot.send_media_group(
                 chat_id=info["chat_id"],
-                photo=photo_file_id,
-                caption=caption
+                media=media,
+                caption=caption,
+                disable_notification=silent
             )
         except Exception as e:
-            logging.warning(f"Ошибка отправки фото {info['nickname']}: {e}")
+            logging.warning(f"Ошибка отправки альбома {info['nickname']}: {e}")
+
+
+def extract_media(message):
+    """Вернуть (kind, file_id) для медиа в сообщении или (None, None)."""
+    if message.photo:
+        return "photo", message.photo[-1].file_id
+    if message.video:
+        return "video", message.video.file_id
+    if message.voice:
+        return "voice", message.voice.file_id
+    if message.document:
+        return "document", message.document.file_id
+    return None, None
+
+
+def buffer_media_group(telegram_app, user_id: int, message, kind: str, file_id: str, caption: str):
+    """
+    Копим элементы альбома по media_group_id.
+    Первый элемент запускает отложенную отправку всего альбома.
+    caption=None — подпись не прошла фильтр, альбом не рассылаем.
+    """
+    group_id = message.media_group_id
+    group = pending_media_groups.get(group_id)
+    if group is None:
+        group = {"user_id": user_id, "items": [], "caption": "", "blocked": False}
+        pending_media_groups[group_id] = group
+        telegram_app.create_task(flush_media_group(telegram_app, group_id))
+
+    group["items"].append((message.message_id, kind, file_id))
+    if caption is None:
+        group["blocked"] = True
+    elif caption and not group["caption"]:
+        group["caption"] = caption
+
+
+async def flush_media_group(telegram_app, group_id: str):
+    """Через MEDIA_GROUP_WINDOW секунд отправить собранный альбом."""
+    await asyncio.sleep(MEDIA_GROUP_WINDOW)
+    group = pending_media_groups.pop(group_id, None)
+    if not group or group["blocked"]:
+        return
+
+    user_id = group["user_id"]
+    if user_id not in users_in_chat:
+        return
+    nickname = users_in_chat[user_id]["nickname"]
+    code = users_in_chat[user_id]["code"]
+    room = users_in_chat[user_id]["room"]
+
+    items = [(kind, file_id) for _, kind, file_id in sorted(group["items"])]
+    if len(items) == 1:
+        kind, file_id = items[0]
+        full_caption = f"{code} {nickname} прислал(а) {MEDIA_LABELS[kind]}"
+        if group["caption"]:
+            full_caption += f"\n{group['caption']}"
+        await broadcast_media(telegram_app, kind, file_id, caption=full_caption, exclude_user=user_id,
+                              room=room, sender=user_id)
+        record_history(room, full_caption, (file_id,) if kind == "photo" else (), sender=user_id)
+        return
+
+    full_caption = f"{code} {nickname} прислал(а) альбом"
+    if group["caption"]:
+        full_caption += f"\n{group['caption']}"
+    await broadcast_media_group(telegram_app, items, caption=full_caption, exclude_user=user_id,
+                                room=room, sender=user_id)
+    record_history(room, full_caption, tuple(file_id for kind, file_id in items if kind == "photo"), sender=user_id)
+
+
+def forget_parted(code: str):
+    """Убрать пользователя из списка /last: он вернулся или вышел повторно."""
+    kept = [entry for entry in parted_users if entry[1] != code]
+    if len(kept) != len(parted_users):
+        parted_users.clear()
+        parted_users.extend(kept)
+
+
+def queue_presence(telegram_app, user_id: int, event: str, code: str, nickname: str, room: int, is_new: bool = False):
+    """
+    Поставить вход/выход в очередь сводки комнаты.
+    Вход и выход одного пользователя в одной комнате в пределах окна гасят друг друга.
+    """
+    prev = pending_presence.pop((user_id, room), None)
+    if prev is not None and prev[0] != event:
+        return
+    pending_presence[(user_id, room)] = (event, code, nickname, is_new)
+    if not presence_state["scheduled"]:
+        presence_state["scheduled"] = True
+        telegram_app.create_task(flush_presence(telegram_app))
+
+
+async def flush_presence(telegram_app):
+    """Через PRESENCE_WINDOW секунд разослать по комнатам сводку входов/выходов."""
+    await asyncio.sleep(PRESENCE_WINDOW)
+    presence_state["scheduled"] = False
+    by_room = {}
+    for (uid, room), event_data in pending_presence.items():
+        by_room.setdefault(room, []).append((uid, event_data))
+    pending_presence.clear()
+
+    for room, events in by_room.items():
+        await broadcast_presence(telegram_app, room, events)
+
+
+async def broadcast_presence(telegram_app, room: int, events: list):
+    """Сводка входов/выходов одной комнаты."""
+    # Одно событие — прежнее сообщение, без самого пользователя
+    if len(events) == 1:
+        uid, (event, code, nickname, is_new) = events[0]
+        if event == "leave":
+            text = f"[Bot] {code} {nickname} вышел из чата."
+        elif is_new:
+            text = f"[Bot] {code} {nickname} входит в чат. Он новенький!"
+        else:
+            text = f"[Bot] {code} {nickname} входит в чат."
+        await broadcast_text(telegram_app, text, exclude_user=uid, room=room, category="system")
+        return
+
+    joined = []
+    joiner_ids = set()
+    left = []
+    for uid, (event, code, nickname, is_new) in events:
+        if event == "join":
+            joined.append(f"{code} {nickname}" + (" (новенький)" if is_new else ""))
+            joiner_ids.add(uid)
+        else:
+            left.append(f"{code} {nickname}")
+
+    lines = []
+    if joined:
+        lines.append("[Bot] Входят в чат: " + ", ".join(joined))
+    if left:
+        lines.append("[Bot] Вышли из чата: " + ", ".join(left))
+    text = "\n".join(lines)
+
+    # Вошедшим в этом окне сводка о себе же не нужна — вычитаем их, как fanout вычитает исключённых
+    recipients, targets = fanout(room, "system")
+    for uid in targets - joiner_ids:
+        info, silent = recipients[uid]
+        try:
+            await telegram_app.bot.send_message(chat_id=info["chat_id"], text=text, disable_notification=silent)
+        except Exception as e:
+            logging.warning(f"Ошибка отправки сводки {info['nickname']}: {e}")
 
 
 def parse_replied_nickname(bot_message_text: str) -> str:
@@ -179,6 +489,703 @@ def parse_replied_nickname(bot_message_text: str) -> str:
     return m.group(1).strip()
 
 
+# ------------------------------------------------------------------------
+# 5.1) ФИЛЬТР КОНТЕНТА ПЕРЕД РАССЫЛКОЙ (мат, ссылки, латиница)
+# ------------------------------------------------------------------------
+# Словарь мата: одно слово/корень на строку, # — комментарий.
+# Слово совпадает только с начала слова текста; «*корень» — в любом месте слова.
+# Файл перечитывается на лету, если изменилось время модификации.
+FILTER_WORDS_FILE = os.getenv("FILTER_WORDS_FILE", "banned_words.txt")
+FILTER_RELOAD_INTERVAL = 30   # не чаще, чем раз в N секунд смотрим mtime словаря
+FILTER_MIN_LETTERS = 8        # короче — проверку раскладки не делаем
+FILTER_MAX_LATIN_RATIO = 0.5  # доля латиницы среди букв, выше — нарушение
+
+LINK_MARKERS = ("http://", "https://", "www.", "t.me/", "telegram.me/")
+# Домены считаются ссылкой, только если перед ними имя, а после — конец слова: site.io, но не Ok.iol
+DOMAIN_MARKERS = (".com", ".ru", ".org", ".net", ".io", ".рф")
+
+FILTER_REASONS = {
+    "profanity": "мат",
+    "link": "ссылки и упоминания",
+    "latin": "не кириллица",
+}
+
+# Действие на категорию: block | mask | flag.
+# Переопределяется переменной FILTER_ACTIONS="profanity:mask,link:block,latin:flag"
+FILTER_ACTIONS = {"profanity": "mask", "link": "block", "latin": "flag"}
+for _item in os.getenv("FILTER_ACTIONS", "").split(","):
+    if ":" in _item:
+        _cat, _action = _item.split(":", 1)
+        FILTER_ACTIONS[_cat.strip()] = _action.strip()
+
+content_filter = {"matcher": None, "mtime": None, "checked_at": 0.0}
+
+
+class AhoCorasick:
+    """Автомат Ахо-Корасик: все вхождения всех шаблонов за один проход по тексту."""
+
+    def __init__(self, patterns: dict):
+        # patterns: { шаблон: категория }
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]   # для узла: ((длина шаблона, категория), ...)
+        for pattern, category in patterns.items():
+            node = 0
+            for ch in pattern:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                node = nxt
+            self.out[node] += ((len(pattern), category),)
+
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self.goto[node].items():
+                queue.append(nxt)
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+
+def load_filter_words() -> list:
+    """Прочитать словарь мата (пустой список, если файла нет)."""
+    try:
+        with open(FILTER_WORDS_FILE, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return []
+    words = []
+    for line in lines:
+        word = line.split("#", 1)[0].strip().lower().replace("ё", "е")
+        if word:
+            words.append(word)
+    return words
+
+
+def get_content_matcher() -> AhoCorasick:
+    """Собранный автомат фильтра; пересобирается, если словарь изменился."""
+    now = time.monotonic()
+    if content_filter["matcher"] is not None and now - content_filter["checked_at"] < FILTER_RELOAD_INTERVAL:
+        return content_filter["matcher"]
+    content_filter["checked_at"] = now
+
+    try:
+        mtime = os.path.getmtime(FILTER_WORDS_FILE)
+    except OSError:
+        mtime = None
+    if content_filter["matcher"] is None or mtime != content_filter["mtime"]:
+        patterns = {marker: "link" for marker in LINK_MARKERS}
+        patterns.update({marker: "domain" for marker in DOMAIN_MARKERS})
+        patterns["@"] = "handle"
+        words = load_filter_words()
+        for word in words:
+            if word.startswith("*"):
+                patterns[word[1:]] = "profanity_infix"
+            else:
+                patterns[word] = "profanity"
+        content_filter["matcher"] = AhoCorasick(patterns)
+        content_filter["mtime"] = mtime
+        logging.info(f"Фильтр: загружено {len(words)} слов из {FILTER_WORDS_FILE}.")
+    return content_filter["matcher"]
+
+
+def check_content(text: str):
+    """
+    Один проход по тексту: совпадения словаря и ссылок + подсчёт кириллицы/латиницы.
+    Возвращаем (set категорий, [(start, end, категория), ...]).
+    """
+    matcher = get_content_matcher()
+    goto, fail, out = matcher.goto, matcher.fail, matcher.out
+    low = text.lower().replace("ё", "е")
+    last = len(low) - 1
+
+    hits = set()
+    spans = []
+    node = 0
+    cyrillic = latin = 0
+    for i, ch in enumerate(low):
+        if "а" <= ch <= "я":
+            cyrillic += 1
+        elif "a" <= ch <= "z":
+            latin += 1
+
+        while node and ch not in goto[node]:
+            node = fail[node]
+        node = goto[node].get(ch, 0)
+        for length, category in out[node]:
+            start = i - length + 1
+            if category == "handle":
+                # @ считается упоминанием, только если за ним идёт имя
+                if i == last or not (low[i + 1].isalnum() or low[i + 1] == "_"):
+                    continue
+                category = "link"
+            elif category == "domain":
+                if start == 0 or not low[start - 1].isalnum() or (i < last and low[i + 1].isalnum()):
+                    continue
+                category = "link"
+            elif category == "profanity":
+                # Только с начала слова: «хлебать», «застрахуйтесь» не трогаем
+                if start and low[start - 1].isalnum():
+                    continue
+            elif category == "profanity_infix":
+                category = "profanity"
+            hits.add(category)
+            spans.append((start, i + 1, category))
+
+    letters = cyrillic + latin
+    if letters >= FILTER_MIN_LETTERS and latin > letters * FILTER_MAX_LATIN_RATIO:
+        hits.add("latin")
+    return hits, spans
+
+
+def mask_spans(text: str, spans: list) -> str:
+    """Заменить отрезки текста звёздочками."""
+    chars = list(text)
+    for start, end, _ in spans:
+        for i in range(start, end):
+            if not chars[i].isspace():
+                chars[i] = "*"
+    return "".join(chars)
+
+
+async def flag_to_moderators(telegram_app, text: str):
+    """Переслать замечание фильтра модераторам (и админам)."""
+    for mod_id in moderator_ids | admin_ids:
+        chat_id = users_in_chat[mod_id]["chat_id"] if mod_id in users_in_chat else mod_id
+        try:
+            await telegram_app.bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logging.warning(f"Не смог отправить флаг модератору {mod_id}: {e}")
+
+
+async def apply_content_filter(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    """
+    Проверка текста до рассылки.
+    Возвращаем текст для рассылки (возможно, замаскированный) или None, если он заблокирован.
+    """
+    if not text:
+        return text
+
+    hits, spans = check_content(text)
+    if not hits:
+        return text
+
+    user_id = update.effective_user.id
+    by_action = {"block": [], "mask": [], "flag": []}
+    for category in sorted(hits):
+        by_action.get(FILTER_ACTIONS.get(category, "flag"), by_action["flag"]).append(category)
+
+    if by_action["block"]:
+        reasons = ", ".join(FILTER_REASONS.get(c, c) for c in by_action["block"])
+        await update.message.reply_text(f"[BOT] Сообщение не отправлено: {reasons}. См. /rules.")
+        logging.info(f"Фильтр: заблокировано сообщение {user_id} ({reasons}).")
+        return None
+
+    if by_action["mask"] and len(text) == len(text.lower()):
+        masked = [span for span in spans if span[2] in by_action["mask"]]
+        text = mask_spans(text, masked)
+
+    # Категории без отрезков (раскладка) маскировать нечем — флагуем
+    to_flag = by_action["flag"] + [c for c in by_action["mask"] if c == "latin"]
+    if to_flag:
+        info = users_in_chat.get(user_id, {})
+        reasons = ", ".join(FILTER_REASONS.get(c, c) for c in to_flag)
+        await flag_to_moderators(
+            context.application,
+            f"[BOT] Фильтр ({reasons}): {info.get('code', '')} {info.get('nickname', user_id)}: {text}"
+        )
+    return text
+
+
+# ------------------------------------------------------------------------
+# 5.2) ОГРАНИЧЕНИЕ ФЛУДА (token bucket на пользователя)
+# ------------------------------------------------------------------------
+# Лимиты по ролям: (пополнение в сообщениях/сек, ёмкость «ведра»).
+# Переопределяются переменной RATE_LIMITS="new:0.5/5,resident:1/8"
+RATE_LIMITS = {
+    "admin": (10.0, 30),
+    "moderator": (5.0, 20),
+    "resident": (1.0, 8),
+    "new": (0.5, 5),
+}
+for _item in os.getenv("RATE_LIMITS", "").split(","):
+    if ":" in _item and "/" in _item:
+        _role, _limit = _item.split(":", 1)
+        _rate, _burst = _limit.split("/", 1)
+        RATE_LIMITS[_role.strip()] = (float(_rate), int(_burst))
+
+MUTE_STEPS = (30, 120, 600, 3600)  # эскалация временных мьютов, сек
+MUTE_FORGIVE_AFTER = 3600          # столько секунд без нарушений — уровень сбрасывается
+
+rate_buckets = {}  # { user_id: [tokens, last_ts] }
+flood_mutes = {}   # { user_id: {"until": ts, "level": n} }
+
+
+def check_flood(user_id: int):
+    """
+    O(1) проверка лимита.
+    Возвращаем (можно ли, на сколько секунд только что выдан мьют — 0, если не выдан).
+    """
+    now = time.monotonic()
+    mute = flood_mutes.get(user_id)
+    if mute and now < mute["until"]:
+        return False, 0
+
+    rate, burst = RATE_LIMITS.get(get_user_role(user_id), RATE_LIMITS["new"])
+    bucket = rate_buckets.get(user_id)
+    if bucket is None:
+        bucket = rate_buckets[user_id] = [burst, now]
+
+    tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+    bucket[1] = now
+    if tokens >= 1:
+        bucket[0] = tokens - 1
+        return True, 0
+    bucket[0] = tokens
+
+    # Ведро пустое — мьют, с каждым повтором длиннее
+    if mute is None or now - mute["until"] > MUTE_FORGIVE_AFTER:
+        level = 0
+    else:
+        level = min(mute["level"] + 1, len(MUTE_STEPS) - 1)
+    duration = MUTE_STEPS[level]
+    flood_mutes[user_id] = {"until": now + duration, "level": level}
+    logging.info(f"Флуд: {user_id} в муте на {duration} сек (уровень {level}).")
+    return False, duration
+
+
+async def flood_guard(update: Update, user_id: int) -> bool:
+    """True — можно продолжать. Иначе один раз сообщаем о мьюте и возвращаем False."""
+    allowed, muted_for = check_flood(user_id)
+    if allowed:
+        return True
+
+    query = update.callback_query
+    if muted_for:
+        text = f"[BOT] Слишком много сообщений. Мьют на {muted_for} сек."
+        if query:
+            await query.answer(text, show_alert=True)
+        else:
+            await update.message.reply_text(text)
+    elif query:
+        await query.answer()
+    return False
+
+
+# ------------------------------------------------------------------------
+# 5.3) ИСТОРИЯ ЧАТА ДЛЯ НОВИЧКОВ (кольцевой буфер)
+# ------------------------------------------------------------------------
+HISTORY_MAX_LINES = int(os.getenv("HISTORY_MAX_LINES", "200"))
+HISTORY_MAX_BYTES = int(os.getenv("HISTORY_MAX_BYTES", "65536"))
+HISTORY_ON_START = int(os.getenv("HISTORY_ON_START", "20"))  # сколько строк показать при /start
+HISTORY_CHUNK_CHARS = 3500  # размер одного сообщения-куска (лимит Telegram — 4096)
+ALBUM_MAX_ITEMS = 10        # лимит send_media_group
+
+# { room_id: {"lines": deque[(text, (photo_file_id, ...), размер, sender)], "bytes": int, "rendered": { n: (chunks, photos) }} }
+room_histories = {}
+
+
+def get_room_history(room: int) -> dict:
+    """Буфер истории комнаты (создаётся при первом обращении)."""
+    history = room_histories.get(room)
+    if history is None:
+        history = room_histories[room] = {
+            "lines": deque(maxlen=HISTORY_MAX_LINES),
+            "bytes": 0,
+            "rendered": {},
+        }
+    return history
+
+
+def record_history(room: int, text: str, photos: tuple = (), sender: int = None):
+    """Добавить публичную строку (и фото) sender'а в буфер комнаты, держа лимиты по строкам и байтам."""
+    history = get_room_history(room)
+    lines = history["lines"]
+    size = len(text.encode("utf-8")) + sum(len(p) for p in photos)
+    if len(lines) == lines.maxlen:
+        history["bytes"] -= lines[0][2]
+    lines.append((text, photos, size, sender))
+    history["bytes"] += size
+
+    while history["bytes"] > HISTORY_MAX_BYTES and len(lines) > 1:
+        history["bytes"] -= lines.popleft()[2]
+    history["rendered"].clear()
+
+
+def render_history(room: int, n: int, hidden: set = None):
+    """
+    Последние n строк комнаты без строк отправителей из hidden,
+    склеенные в несколько кусков по HISTORY_CHUNK_CHARS.
+    Общий результат (hidden пуст) кэшируется до следующей записи в буфер.
+    Возвращаем (chunks, photos).
+    """
+    history = get_room_history(room)
+    if not hidden:
+        cached = history["rendered"].get(n)
+        if cached is not None:
+            return cached
+        entries = list(history["lines"])[-n:] if n > 0 else []
+    else:
+        entries = [entry for entry in history["lines"] if entry[3] not in hidden][-n:] if n > 0 else []
+    chunks = []
+    current = ["[BOT] Последние сообщения в чате:"]
+    length = len(current[0])
+    photos = []
+    for text, entry_photos, _, _ in entries:
+        line = text.replace("\n", " ")
+        if entry_photos:
+            line += " [фото]" if len(entry_photos) == 1 else f" [фото ×{len(entry_photos)}]"
+            photos.extend(entry_photos)
+        line = line[:HISTORY_CHUNK_CHARS]
+        if length + len(line) + 1 > HISTORY_CHUNK_CHARS:
+            chunks.append("\n".join(current))
+            current = []
+            length = 0
+        current.append(line)
+        length += len(line) + 1
+    if entries:
+        chunks.append("\n".join(current))
+
+    # Фото — не больше одного альбома, самые свежие: иначе /history 200 = десятки send_media_group
+    result = (chunks, photos[-ALBUM_MAX_ITEMS:])
+    if not hidden:
+        history["rendered"][n] = result
+    return result
+
+
+async def send_history(bot, chat_id: int, room: int, n: int, reader: int = None) -> bool:
+    """Отправить историю комнаты читателю reader (без тех, кого он игнорирует). False — истории нет."""
+    chunks, photos = render_history(room, n, ignoring.get(reader))
+    if not chunks:
+        return False
+
+    for chunk in chunks:
+        await bot.send_message(chat_id=chat_id, text=chunk)
+    for i in range(0, len(photos), ALBUM_MAX_ITEMS):
+        batch = photos[i:i + ALBUM_MAX_ITEMS]
+        if len(batch) == 1:
+            await bot.send_photo(chat_id=chat_id, photo=batch[0])
+        else:
+            await bot.send_media_group(chat_id=chat_id, media=[InputMediaPhoto(p) for p in batch])
+    return True
+
+
+# ------------------------------------------------------------------------
+# 5.4) НАДЁЖНАЯ ОТПРАВКА ЛС И ОПРОСОВ (outbox в SQLite)
+# ------------------------------------------------------------------------
+# Запись попадает в базу до отправки и удаляется после успеха (at-least-once).
+# Коммиты групповые: одна запись на диск на все отправки за OUTBOX_COMMIT_INTERVAL.
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.sqlite3")
+OUTBOX_COMMIT_INTERVAL = 0.05  # сек
+OUTBOX_LEASE = 30              # сек, пока первая попытка «своя», фоновый повтор её не трогает
+OUTBOX_POLL_INTERVAL = 1.0     # как часто фоновый повтор смотрит в базу
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_MAX_BACKOFF = 600
+
+outbox = {"db": None, "commit_waiter": None, "commit_timer": None, "worker": None}
+
+
+def get_outbox_db():
+    """Открыть (при первом обращении) базу outbox."""
+    if outbox["db"] is None:
+        db = sqlite3.connect(OUTBOX_DB)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " key TEXT PRIMARY KEY,"
+            " kind TEXT NOT NULL,"
+            " chat_id INTEGER NOT NULL,"
+            " text TEXT NOT NULL,"
+            " markup TEXT,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_try REAL NOT NULL,"
+            " created REAL NOT NULL)"
+        )
+        db.commit()
+        outbox["db"] = db
+    return outbox["db"]
+
+
+def _outbox_flush():
+    waiter = outbox["commit_waiter"]
+    outbox["commit_waiter"] = None
+    outbox["commit_timer"] = None
+    try:
+        outbox["db"].commit()
+    except Exception as e:
+        logging.error(f"Outbox: ошибка коммита: {e}")
+        waiter.set_exception(e)
+        return
+    waiter.set_result(None)
+
+
+def outbox_schedule_commit():
+    """Запланировать групповой коммит (если ещё не запланирован) и вернуть его future."""
+    waiter = outbox["commit_waiter"]
+    if waiter is None:
+        loop = asyncio.get_running_loop()
+        waiter = outbox["commit_waiter"] = loop.create_future()
+        # Ошибку коммита уже залогировал _outbox_flush; без await (из outbox_deliver) её забираем здесь
+        waiter.add_done_callback(lambda f: f.cancelled() or f.exception())
+        outbox["commit_timer"] = loop.call_later(OUTBOX_COMMIT_INTERVAL, _outbox_flush)
+    return waiter
+
+
+def outbox_close():
+    """При остановке: досрочно выполнить отложенный коммит и закрыть базу."""
+    if outbox["commit_timer"] is not None:
+        outbox["commit_timer"].cancel()
+        _outbox_flush()
+    if outbox["db"] is not None:
+        outbox["db"].close()
+        outbox["db"] = None
+
+
+def outbox_enqueue(key: str, kind: str, chat_id: int, text: str, markup=None) -> bool:
+    """
+    Записать отправку в outbox (без коммита).
+    False — запись с таким ключом уже есть (повтор того же апдейта).
+    """
+    now = time.time()
+    cur = get_outbox_db().execute(
+        "INSERT OR IGNORE INTO outbox (key, kind, chat_id, text, markup, next_try, created)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (key, kind, chat_id, text, markup.to_json() if markup else None, now + OUTBOX_LEASE, now)
+    )
+    return cur.rowcount > 0
+
+
+async def outbox_deliver(bot, key: str, chat_id: int, text: str, markup=None, attempts: int = 0):
+    """
+    Одна попытка отправки записи. Возвращаем (статус, Message или None):
+    "sent" — доставлено, "queued" — запись осталась на повтор, "failed" — запись удалена без доставки.
+    """
+    db = get_outbox_db()
+    # ЛС — категория pm; в личке chat_id совпадает с user_id
+    silent = is_silent(chat_id, "pm") if key.startswith("pm:") else False
+    try:
+        msg = await bot.send_message(chat_id=chat_id, text=text, reply_markup=markup, disable_notification=silent)
+    except (Forbidden, BadRequest) as e:
+        # Бот заблокирован или чат недоступен — повторять бессмысленно
+        logging.warning(f"Outbox: {key} не доставлено: {e}")
+        db.execute("DELETE FROM outbox WHERE key = ?", (key,))
+        outbox_schedule_commit()
+        return "failed", None
+    except Exception as e:
+        attempts += 1
+        if attempts >= OUTBOX_MAX_ATTEMPTS:
+            logging.error(f"Outbox: {key} — попытки исчерпаны: {e}")
+            db.execute("DELETE FROM outbox WHERE key = ?", (key,))
+            outbox_schedule_commit()
+            return "failed", None
+        delay = e.retry_after if isinstance(e, RetryAfter) else min(2 ** attempts, OUTBOX_MAX_BACKOFF)
+        logging.warning(f"Outbox: {key}, попытка {attempts}, повтор через {delay} сек: {e}")
+        db.execute(
+            "UPDATE outbox SET attempts = ?, next_try = ? WHERE key = ?",
+            (attempts, time.time() + delay, key)
+        )
+        outbox_schedule_commit()
+        return "queued", None
+
+    db.execute("DELETE FROM outbox WHERE key = ?", (key,))
+    outbox_schedule_commit()
+    return "sent", msg
+
+
+async def outbox_send(bot, key: str, kind: str, chat_id: int, text: str, markup=None):
+    """
+    Записать, дождаться группового коммита и отправить.
+    Статус как у outbox_deliver или "duplicate" — такая запись уже есть (повтор апдейта).
+    """
+    if not outbox_enqueue(key, kind, chat_id, text, markup):
+        logging.info(f"Outbox: {key} уже в очереди, пропускаем повтор.")
+        return "duplicate", None
+    await asyncio.shield(outbox_schedule_commit())
+    return await outbox_deliver(bot, key, chat_id, text, markup)
+
+
+def attach_poll_message(key: str, chat_id: int, message_id: int):
+    """Доставленное повтором сообщение опроса привязать к опросу, если он ещё идёт."""
+    # key: poll:{creator_id}:{update_id}:{user_id}
+    _, creator, update_id, uid = key.split(":")
+    poll_data = polls.get(int(creator))
+    if not poll_data or not poll_data["active"] or poll_data["outbox_prefix"] != f"poll:{creator}:{update_id}:":
+        return
+    poll_data["message_ids"][int(uid)] = message_id
+    poll_data["chat_ids"][int(uid)] = chat_id
+
+
+async def outbox_worker(telegram_app):
+    """Фоновые повторы созревших записей outbox."""
+    db = get_outbox_db()
+    while True:
+        await asyncio.sleep(OUTBOX_POLL_INTERVAL)
+        now = time.time()
+        try:
+            rows = db.execute(
+                "SELECT key, kind, chat_id, text, markup, attempts FROM outbox"
+                " WHERE next_try <= ? ORDER BY created LIMIT 50",
+                (now,)
+            ).fetchall()
+            # Берём в работу: чтобы параллельная итерация не взяла те же записи
+            db.executemany(
+                "UPDATE outbox SET next_try = ? WHERE key = ?",
+                [(now + OUTBOX_LEASE, row[0]) for row in rows]
+            )
+        except sqlite3.Error as e:
+            logging.error(f"Outbox: ошибка чтения очереди: {e}")
+            continue
+
+        for key, kind, chat_id, text, markup_json, attempts in rows:
+            # Одна битая запись или сбой базы не должны останавливать повторы
+            try:
+                markup = InlineKeyboardMarkup.de_json(json.loads(markup_json), telegram_app.bot) if markup_json else None
+                _, msg = await outbox_deliver(telegram_app.bot, key, chat_id, text, markup, attempts)
+                if msg is not None and kind == "poll":
+                    attach_poll_message(key, chat_id, msg.message_id)
+            except Exception as e:
+                logging.error(f"Outbox: ошибка повтора {key}: {e}")
+
+
+def outbox_startup():
+    """
+    При старте: ЛС из прошлого запуска отправляем сразу.
+    Опросы живут только в памяти — их неотправленные сообщения выбрасываем.
+    """
+    db = get_outbox_db()
+    dropped = db.execute("DELETE FROM outbox WHERE kind = 'poll'").rowcount
+    replay = db.execute("UPDATE outbox SET next_try = 0").rowcount
+    db.commit()
+    if dropped or replay:
+        logging.info(f"Outbox: к повтору {replay}, устаревших опросов удалено {dropped}.")
+
+
+# ------------------------------------------------------------------------
+# 5.5) ПОВТОРЫ И СПАМ-РАССЫЛКИ (SimHash перед рассылкой)
+# ------------------------------------------------------------------------
+DUP_WINDOW = int(os.getenv("DUP_WINDOW", "600"))  # сек: сколько помним отпечатки
+DUP_MAX_DISTANCE = int(os.getenv("DUP_MAX_DISTANCE", "8"))  # из 64 бит; у несвязанных текстов ~32
+DUP_MIN_LENGTH = 16        # короче (после нормализации) не проверяем: «да», «всем привет»
+DUP_PER_SENDER = 8         # последних отпечатков на отправителя
+DUP_GLOBAL = 256           # последних отпечатков по всему чату
+DUP_GLOBAL_REPEATS = 3     # столько копий от других за окно — похоже на массовую рассылку
+DUP_SHINGLE = 4            # длина символьного шингла
+
+# Латиница, похожая на кириллицу: «привет» и «привeт» должны совпасть
+HOMOGLYPHS = str.maketrans("aeopcxyk", "аеорсхук")
+NON_WORD_RE = re.compile(r"[\W_]+")
+
+# 64 счётчика по 16 бит в одном большом int: «разворачиваем» байт хеша в 8 счётчиков
+SIMHASH_LANE = 16
+SIMHASH_SPREAD = [
+    [sum(((b >> i) & 1) << (SIMHASH_LANE * (8 * j + i)) for i in range(8)) for b in range(256)]
+    for j in range(8)
+]
+SIMHASH_LANE_MASK = (1 << SIMHASH_LANE) - 1
+
+sender_fingerprints = {}                        # { user_id: deque[(ts, fp)] }
+recent_fingerprints = deque(maxlen=DUP_GLOBAL)  # (ts, fp, user_id)
+
+
+def text_fingerprint(text: str):
+    """
+    SimHash по символьным шинглам нормализованного текста.
+    Регистр, пробелы, пунктуация и латинские «двойники» букв не влияют.
+    Возвращаем 64-битный отпечаток или None, если текст слишком короткий.
+    """
+    norm = NON_WORD_RE.sub("", text.lower().replace("ё", "е").translate(HOMOGLYPHS))
+    if len(norm) < DUP_MIN_LENGTH:
+        return None
+
+    s0, s1, s2, s3, s4, s5, s6, s7 = SIMHASH_SPREAD
+    counters = 0
+    count = len(norm) - DUP_SHINGLE + 1
+    for i in range(count):
+        h = hash(norm[i:i + DUP_SHINGLE])
+        counters += (s0[h & 255] + s1[(h >> 8) & 255] + s2[(h >> 16) & 255] + s3[(h >> 24) & 255]
+                     + s4[(h >> 32) & 255] + s5[(h >> 40) & 255] + s6[(h >> 48) & 255] + s7[(h >> 56) & 255])
+
+    fp = 0
+    for bit in range(64):
+        if ((counters >> (SIMHASH_LANE * bit)) & SIMHASH_LANE_MASK) * 2 > count:
+            fp |= 1 << bit
+    return fp
+
+
+def check_duplicate(user_id: int, text: str):
+    """
+    Проверка перед рассылкой.
+    Возвращаем None (можно) или причину:
+    "repeat" — сам недавно писал то же;
+    "spam" — то же уже разослали несколько других, и у отправителя есть свой признак
+             (новичок или ссылка в тексте);
+    "mass" — то же пишут многие, но признаков спама нет (поздравления, «держитесь»):
+             рассылаем, а модераторам — флаг, один раз на такую волну.
+    """
+    fp = text_fingerprint(text)
+    if fp is None:
+        return None
+    now = time.monotonic()
+
+    own = sender_fingerprints.get(user_id)
+    if own is None:
+        own = sender_fingerprints[user_id] = deque(maxlen=DUP_PER_SENDER)
+    for ts, old in own:
+        if now - ts < DUP_WINDOW and (fp ^ old).bit_count() <= DUP_MAX_DISTANCE:
+            return "repeat"
+
+    copies = 0
+    for ts, old, sender in recent_fingerprints:
+        if sender != user_id and now - ts < DUP_WINDOW and (fp ^ old).bit_count() <= DUP_MAX_DISTANCE:
+            copies += 1
+
+    reason = None
+    if copies >= DUP_GLOBAL_REPEATS:
+        # Совпадение с чужими само по себе — нормальная жизнь чата; нужен признак отправителя
+        if get_user_role(user_id) == "new" or "link" in check_content(text)[0]:
+            return "spam"
+        if copies == DUP_GLOBAL_REPEATS:
+            reason = "mass"
+
+    own.append((now, fp))
+    recent_fingerprints.append((now, fp, user_id))
+    return reason
+
+
+async def duplicate_guard(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, text: str) -> bool:
+    """True — можно рассылать. Повторы и спам-рассылки гасим до fan-out."""
+    if user_id in admin_ids or user_id in moderator_ids:
+        return True
+    reason = check_duplicate(user_id, text)
+    if reason is None:
+        return True
+
+    if reason == "mass":
+        info = users_in_chat.get(user_id, {})
+        await flag_to_moderators(
+            context.application,
+            f"[BOT] Повторы: один и тот же текст от нескольких пользователей. "
+            f"Последний — {info.get('code', '')} {info.get('nickname', user_id)}: {text}"
+        )
+        return True
+
+    if reason == "repeat":
+        await update.message.reply_text("[BOT] Ты уже отправлял(а) это недавно — повтор не разослан.")
+    else:
+        await update.message.reply_text("[BOT] Похоже на массовую рассылку — сообщение не отправлено.")
+    logging.info(f"Повторы: сообщение {user_id} не разослано ({reason}).")
+    return False
+
+
 # ------------------------------------------------------------------------
 # 6) ХЕНДЛЕРЫ КОМАНД: /start, /stop
 # ------------------------------------------------------------------------
@@ -213,13 +1220,18 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
         join_count = 1
 
-    # Вставляем в активный список
-    users_in_chat[user_id] = {
+    forget_parted(code)
+
+    # Вставляем в активный список и в комнату, где есть место
+    room = pick_room(user_id)
+    users_history[user_id]["room"] = room
+    join_room(user_id, {
         "nickname": nickname,
         "code": code,
         "chat_id": chat_id,
+        "room": room,
         "last_activity": datetime.datetime.now()
-    }
+    })
 
     # Приветственное сообщение
     await update.message.reply_text(
@@ -227,17 +1239,19 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Чтобы выйти — /stop.\n\n"
         f"Твой ник: {nickname}\n"
         f"Твой код: {code}\n"
+        f"Твоя комната: {room}\n"
         "Приятного общения!"
     )
 
-    # Сообщение в общий чат о входе
-    if join_count == 1:
-        msg_broadcast = f"[Bot] {code} {nickname} входит в чат. Он новенький!"
-    else:
-        msg_broadcast = f"[Bot] {code} {nickname} входит в чат."
+    # Недавняя переписка, чтобы было понятно, о чём говорят
+    try:
+        await send_history(context.application.bot, chat_id, room, HISTORY_ON_START, reader=user_id)
+    except Exception as e:
+        logging.warning(f"Не смог отправить историю {user_id}: {e}")
 
-    await broadcast_text(context.application, msg_broadcast, exclude_user=user_id)
-    logging.info(f"Пользователь {user_id} => {nickname} (join_count={join_count}).")
+    # Сообщение в общий чат о входе (уходит сводкой раз в PRESENCE_WINDOW)
+    queue_presence(context.application, user_id, "join", code, nickname, room, is_new=join_count == 1)
+    logging.info(f"Пользователь {user_id} => {nickname} (join_count={join_count}, комната {room}).")
 
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -246,16 +1260,15 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("[BOT] Тебя нет в чате. Используй /start, чтобы войти.")
         return
 
-    nickname = users_in_chat[user_id]["nickname"]
-    code = users_in_chat[user_id]["code"]
-    users_in_chat.pop(user_id, None)
+    info = leave_room(user_id)
+    nickname = info["nickname"]
+    code = info["code"]
 
-    parted_users.insert(0, (nickname, code, datetime.datetime.now()))
-    if len(parted_users) > 20:
-        parted_users.pop()
+    forget_parted(code)
+    parted_users.appendleft((nickname, code, datetime.datetime.now()))
 
     await update.message.reply_text("[BOT] Ты вышел из чата. Возвращайся в любой момент через /start.")
-    await broadcast_text(context.application, f"[Bot] {code} {nickname} вышел из чата.", exclude_user=user_id)
+    queue_presence(context.application, user_id, "leave", code, nickname, info["room"])
     logging.info(f"Пользователь {user_id} («{nickname}») вышел из чата.")
 
 
@@ -283,6 +1296,10 @@ async def nick_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(new_nick) > 15:
         await update.message.reply_text("[BOT] Ник слишком длинный (макс 15 символов).")
         return ConversationHandler.END
+    # Ник уходит всей комнате — тот же фильтр, что и для сообщений
+    new_nick = await apply_content_filter(update, context, new_nick)
+    if new_nick is None:
+        return ConversationHandler.END
 
     old_nick = users_in_chat[user_id]["nickname"]
     code = users_in_chat[user_id]["code"]
@@ -291,7 +1308,12 @@ async def nick_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
     users_history[user_id]["nickname"] = new_nick
 
     await update.message.reply_text(f"[BOT] Новый ник: {new_nick}.")
-    await broadcast_text(context.application, f"[Bot] {code} {old_nick} сменил(а) ник на {new_nick}.")
+    await broadcast_text(
+        context.application,
+        f"[Bot] {code} {old_nick} сменил(а) ник на {new_nick}.",
+        room=users_in_chat[user_id]["room"],
+        category="system"
+    )
     update_last_activity(user_id)
     logging.info(f"{user_id} сменил ник с {old_nick} на {new_nick}.")
     return ConversationHandler.END
@@ -302,18 +1324,26 @@ async def nick_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ------------------------------------------------------------------------
-# 8) /list, /last
+# 8) /list, /last, /history
 # ------------------------------------------------------------------------
 async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not users_in_chat:
         await update.message.reply_text("[BOT] В чате никого нет.")
         return
 
-    total_possible = 100  # Шутливое число из исходного кода :)
+    user_id = update.effective_user.id
+    if user_id not in users_in_chat:
+        await update.message.reply_text(
+            f"[BOT] В чате {len(users_in_chat)}, комнат: {len(rooms)}. /start, чтобы войти."
+        )
+        return
+
+    room = users_in_chat[user_id]["room"]
+    members = rooms[room]
     lines = []
     now = datetime.datetime.now()
 
-    for uid, data in users_in_chat.items():
+    for uid, data in members.items():
         diff_sec = (now - data["last_activity"]).total_seconds()
         moon = get_moon_symbol(diff_sec)
         role = get_user_role(uid)
@@ -322,11 +1352,45 @@ async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         line = f"{moon} {role} {code} {nick}"
         lines.append(line)
 
-    msg = f"[BOT] В чате {len(users_in_chat)} (из {total_possible}):\n" + "\n".join(lines)
+    msg = f"[BOT] Комната {room}: {len(members)} (из {ROOM_CAPACITY}):\n" + "\n".join(lines)
     await update.message.reply_text(msg)
     update_last_activity(update.effective_user.id)
 
 
+async def last_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not parted_users:
+        await update.message.reply_text("[BOT] Никто ещё не выходил.")
+        return
+
+    now = datetime.datetime.now()
+    lines = []
+    for nick, code, left_at in parted_users:
+        moon = get_moon_symbol((now - left_at).total_seconds())
+        lines.append(f"{moon} {code} {nick} ({left_at.strftime('%H:%M')})")
+
+    await update.message.reply_text("[BOT] Недавно вышли:\n" + "\n".join(lines))
+    update_last_activity(update.effective_user.id)
+
+
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_in_chat:
+        await update.message.reply_text("[BOT] Тебя нет в чате.")
+        return
+
+    n = HISTORY_ON_START
+    if context.args:
+        if not context.args[0].isdigit():
+            await update.message.reply_text("[BOT] /history N — последние N сообщений.")
+            return
+        n = min(int(context.args[0]), HISTORY_MAX_LINES)
+
+    room = users_in_chat[user_id]["room"]
+    if not await send_history(context.application.bot, update.effective_chat.id, room, n, reader=user_id):
+        await update.message.reply_text("[BOT] История пока пуста.")
+    update_last_activity(user_id)
+
+
 # ------------------------------------------------------------------------
 # 9) /help, /rules, /about, /ping
 # ------------------------------------------------------------------------
@@ -337,10 +1401,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/stop - Выйти из чата\n"
         "/nick - Сменить ник\n"
         "/list - Список пользователей\n"
+        "/last - Кто недавно вышел\n"
+        "/history [N] - Последние сообщения чата\n"
         "/msg - Отправить личное сообщение\n"
         "/getmsg - Получить личные сообщения\n"
         "/hug [CODE] - Обнять пользователя\n"
         "/search [ТЕКСТ] - Поиск пользователя по нику\n"
+        "/ignore [CODE] - Скрыть сообщения пользователя\n"
+        "/unignore CODE - Снова видеть пользователя\n"
         "/poll - Создать опрос\n"
         "/polldone - Завершить опрос\n"
         "/notify - Настройки уведомлений\n"
@@ -376,7 +1444,11 @@ async def about(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update_last_activity(update.effective_user.id)
 
 async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Pong!")
+    # Админам — подробности: откуда тормоза, от нас или от Telegram
+    if update.effective_user.id in admin_ids:
+        await update.message.reply_text(diagnostics_report())
+    else:
+        await update.message.reply_text("Pong!")
     update_last_activity(update.effective_user.id)
 
 
@@ -395,32 +1467,46 @@ async def msg_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if len(context.args) >= 2:
         code = context.args[0]
         text_msg = " ".join(context.args[1:])
-        to_user = get_user_by_code(code)
+        to_user = get_user_by_code(code, users_in_chat[user_id]["room"])
         if to_user is None:
             await update.message.reply_text("[BOT] Не нашли пользователя с таким кодом.")
             return ConversationHandler.END
+        if to_user in ignored_by.get(user_id, ()):
+            # Молча отбрасываем: игнорируемый не должен узнать, что его заглушили
+            await update.message.reply_text(f"[BOT] Личное сообщение отправлено для {code}.")
+            update_last_activity(user_id)
+            return ConversationHandler.END
 
         from_nick = users_in_chat[user_id]["nickname"]
         ensure_user_in_dicts(to_user)
         # Сохраняем копию
         private_messages[to_user].append({"from": from_nick, "text": text_msg})
 
-        # Отправляем получателю сразу
+        # Отправляем получателю сразу (через outbox — с повторами)
         chat_to = users_in_chat[to_user]["chat_id"]
-        await context.application.bot.send_message(
-            chat_id=chat_to,
-            text=f"[ЛС от {from_nick}]: {text_msg}"
+        status, _ = await outbox_send(
+            context.application.bot,
+            f"pm:{update.update_id}",
+            "pm",
+            chat_to,
+            f"[ЛС от {from_nick}]: {text_msg}"
         )
 
-        await update.message.reply_text(f"[BOT] Личное сообщение отправлено для {code}.")
+        if status == "sent":
+            await update.message.reply_text(f"[BOT] Личное сообщение отправлено для {code}.")
+        elif status == "queued":
+            await update.message.reply_text(f"[BOT] Сообщение для {code} в очереди, доставим чуть позже.")
+        elif status == "failed":
+            await update.message.reply_text(f"[BOT] Не удалось доставить сообщение для {code}.")
+        # duplicate — повтор того же апдейта, на первый уже ответили
         update_last_activity(user_id)
         return ConversationHandler.END
 
-    # иначе — показать inline-список (кнопочки) всех
+    # иначе — показать inline-список (кнопочки) всех в комнате
     keyboard = []
     row = []
     i = 0
-    for uid, data in users_in_chat.items():
+    for uid, data in rooms[users_in_chat[user_id]["room"]].items():
         if uid == user_id:
             continue
         i += 1
@@ -470,6 +1556,13 @@ async def msg_enter_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if recipient_id not in users_in_chat:
         await update.message.reply_text("[BOT] Похоже, пользователь вышел.")
         return ConversationHandler.END
+    if recipient_id in ignored_by.get(user_id, ()):
+        # Молча отбрасываем: игнорируемый не должен узнать, что его заглушили
+        info = users_in_chat[recipient_id]
+        await update.message.reply_text(f"[BOT] Сообщение для {info['code']} {info['nickname']} отправлено.")
+        context.user_data.pop("msg_recipient", None)
+        update_last_activity(user_id)
+        return ConversationHandler.END
 
     from_nick = users_in_chat[user_id]["nickname"]
     text_msg = update.message.text
@@ -481,16 +1574,29 @@ async def msg_enter_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Сохраняем копию
     private_messages[recipient_id].append({"from": from_nick, "text": text_msg})
 
-    # Отправляем получателю
+    # Отправляем получателю (через outbox — с повторами)
     chat_to = users_in_chat[recipient_id]["chat_id"]
-    await context.application.bot.send_message(
-        chat_id=chat_to,
-        text=f"[ЛС от {from_nick}]: {text_msg}"
+    status, _ = await outbox_send(
+        context.application.bot,
+        f"pm:{update.update_id}",
+        "pm",
+        chat_to,
+        f"[ЛС от {from_nick}]: {text_msg}"
     )
 
-    await update.message.reply_text(
-        f"[BOT] Сообщение для {to_code} {to_nick} отправлено."
-    )
+    if status == "sent":
+        await update.message.reply_text(
+            f"[BOT] Сообщение для {to_code} {to_nick} отправлено."
+        )
+    elif status == "queued":
+        await update.message.reply_text(
+            f"[BOT] Сообщение для {to_code} {to_nick} в очереди, доставим чуть позже."
+        )
+    elif status == "failed":
+        await update.message.reply_text(
+            f"[BOT] Не удалось доставить сообщение для {to_code} {to_nick}."
+        )
+    # duplicate — повтор того же апдейта, на первый уже ответили
     logging.info(f"ЛС: {from_nick} -> {to_nick}: {text_msg}")
 
     context.user_data.pop("msg_recipient", None)
@@ -536,8 +1642,11 @@ async def hug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Если /hug CODE
     if context.args:
+        if not await flood_guard(update, user_id):
+            return ConversationHandler.END
         code = context.args[0]
-        to_user = get_user_by_code(code)
+        room = users_in_chat[user_id]["room"]
+        to_user = get_user_by_code(code, room)
         if not to_user:
             await update.message.reply_text("[BOT] Не нашли пользователя с таким кодом.")
             return ConversationHandler.END
@@ -546,15 +1655,15 @@ async def hug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from_code = users_in_chat[user_id]["code"]
         to_nick = users_in_chat[to_user]["nickname"]
         text = f"[Bot] {from_code} {from_nick} обнял(а) {to_nick}!"
-        await broadcast_text(context.application, text)
+        await broadcast_text(context.application, text, room=room, category="hug", sender=user_id)
         update_last_activity(user_id)
         return ConversationHandler.END
 
-    # Иначе inline-список
+    # Иначе inline-список комнаты
     keyboard = []
     row = []
     i = 0
-    for uid, data in users_in_chat.items():
+    for uid, data in rooms[users_in_chat[user_id]["room"]].items():
         if uid == user_id:
             continue
         i += 1
@@ -582,13 +1691,16 @@ async def hug_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("Ошибка.")
         return ConversationHandler.END
 
+    if not await flood_guard(update, user_id):
+        return HUG_SELECT
+
     to_user_id = int(parts[1])
     from_nick = users_in_chat[user_id]["nickname"]
     from_code = users_in_chat[user_id]["code"]
     to_nick = users_in_chat[to_user_id]["nickname"]
 
     text = f"[Bot] {from_code} {from_nick} обнял(а) {to_nick}!"
-    await broadcast_text(context.application, text)
+    await broadcast_text(context.application, text, room=users_in_chat[user_id]["room"], category="hug", sender=user_id)
     await query.message.edit_text("Обнимашка отправлена!")
     await query.answer()
     update_last_activity(user_id)
@@ -616,7 +1728,7 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     pattern = " ".join(context.args).lower()
     results = []
-    for uid, info in users_in_chat.items():
+    for uid, info in rooms[users_in_chat[user_id]["room"]].items():
         if pattern in info["nickname"].lower():
             results.append(f"{info['code']} {info['nickname']}")
 
@@ -627,6 +1739,68 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update_last_activity(user_id)
 
 
+# ------------------------------------------------------------------------
+# 12.1) /ignore, /unignore
+# ------------------------------------------------------------------------
+async def ignore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_in_chat:
+        await update.message.reply_text("[BOT] Тебя нет в чате.")
+        return
+
+    # Без аргументов — показать список
+    if not context.args:
+        muted = ignoring.get(user_id)
+        if not muted:
+            await update.message.reply_text("[BOT] Ты никого не игнорируешь. /ignore CODE — скрыть пользователя.")
+            return
+        lines = [f"{users_history[uid]['code']} {users_history[uid]['nickname']}" for uid in muted]
+        await update.message.reply_text("[BOT] Ты игнорируешь:\n" + "\n".join(lines))
+        return
+
+    code = context.args[0]
+    target = get_user_by_code(code)
+    if target is None:
+        await update.message.reply_text("[BOT] Не нашли пользователя с таким кодом.")
+        return
+    if target == user_id:
+        await update.message.reply_text("[BOT] Себя игнорировать нельзя.")
+        return
+
+    ignored_by.setdefault(target, set()).add(user_id)
+    ignoring.setdefault(user_id, set()).add(target)
+    await update.message.reply_text(
+        f"[BOT] Сообщения {users_in_chat[target]['code']} {users_in_chat[target]['nickname']} скрыты. "
+        "Вернуть — /unignore CODE."
+    )
+    update_last_activity(user_id)
+    logging.info(f"{user_id} игнорирует {target}.")
+
+async def unignore_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if not context.args:
+        await update.message.reply_text("[BOT] /unignore CODE — снова видеть пользователя.")
+        return
+
+    # Ищем среди своих игнорируемых: пользователь мог уже выйти из чата
+    code = context.args[0].lower()
+    target = next((uid for uid in ignoring.get(user_id, ()) if users_history[uid]["code"].lower() == code), None)
+    if target is None:
+        await update.message.reply_text("[BOT] Ты не игнорируешь пользователя с таким кодом.")
+        return
+
+    ignoring[user_id].discard(target)
+    if not ignoring[user_id]:
+        del ignoring[user_id]
+    ignored_by[target].discard(user_id)
+    if not ignored_by[target]:
+        del ignored_by[target]
+
+    await update.message.reply_text(f"[BOT] {users_history[target]['code']} {users_history[target]['nickname']} снова виден.")
+    update_last_activity(user_id)
+    logging.info(f"{user_id} больше не игнорирует {target}.")
+
+
 # ------------------------------------------------------------------------
 # 13) /poll
 # ------------------------------------------------------------------------
@@ -654,7 +1828,13 @@ async def poll_received_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if user_id not in users_in_chat:
         return ConversationHandler.END
 
-    text = update.message.text.strip()
+    if not await flood_guard(update, user_id):
+        return POLL_AWAITING_QUESTION
+
+    # Вопрос и варианты уходят всей комнате — тот же фильтр, что и для сообщений
+    text = await apply_content_filter(update, context, update.message.text.strip())
+    if text is None:
+        return ConversationHandler.END
     lines = text.split("\n")
     if len(lines) < 2:
         await update.message.reply_text("[BOT] Нужно минимум 1 вопрос и 1 вариант ответа.")
@@ -669,7 +1849,9 @@ async def poll_received_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "votes": {opt: set() for opt in options},
         "active": True,
         "message_ids": {},
-        "chat_ids": {}
+        "chat_ids": {},
+        "room": users_in_chat[user_id]["room"],
+        "outbox_prefix": f"poll:{user_id}:{update.update_id}:"
     }
 
     from_nick = users_in_chat[user_id]["nickname"]
@@ -685,17 +1867,22 @@ async def poll_received_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return InlineKeyboardMarkup(kb)
 
     markup = build_poll_keyboard(user_id)
-    for uid, info in users_in_chat.items():
-        try:
-            msg = await context.application.bot.send_message(
-                chat_id=info["chat_id"],
-                text=header_text,
-                reply_markup=markup
-            )
+    prefix = polls[user_id]["outbox_prefix"]
+
+    # Сначала все записи в outbox и один общий коммит, потом отправка (игнорирующим автора — нет)
+    ignoring_creator = ignored_by.get(user_id, ())
+    recipients = [
+        (uid, info["chat_id"]) for uid, info in list(rooms[polls[user_id]["room"]].items())
+        if uid not in ignoring_creator
+        and outbox_enqueue(f"{prefix}{uid}", "poll", info["chat_id"], header_text, markup)
+    ]
+    await asyncio.shield(outbox_schedule_commit())
+
+    for uid, chat_id in recipients:
+        _, msg = await outbox_deliver(context.application.bot, f"{prefix}{uid}", chat_id, header_text, markup)
+        if msg is not None:
             polls[user_id]["message_ids"][uid] = msg.message_id
-            polls[user_id]["chat_ids"][uid] = info["chat_id"]
-        except Exception as e:
-            logging.warning(f"Не смог отправить опрос {info['nickname']}: {e}")
+            polls[user_id]["chat_ids"][uid] = chat_id
 
     update_last_activity(user_id)
     return ConversationHandler.END
@@ -714,7 +1901,7 @@ async def poll_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("[BOT] Твой опрос завершён.")
 
     # Уберём кнопки у всех
-    for uid, msg_id in polls[user_id]["message_ids"].items():
+    for uid, msg_id in list(polls[user_id]["message_ids"].items()):
         chat_id = polls[user_id]["chat_ids"][uid]
         try:
             await context.application.bot.edit_message_reply_markup(
@@ -769,7 +1956,7 @@ async def poll_vote_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     new_text = "\n".join(out_lines)
     # Обновим сообщение у всех
-    for uid, msg_id in poll_data["message_ids"].items():
+    for uid, msg_id in list(poll_data["message_ids"].items()):
         chat_id = poll_data["chat_ids"][uid]
         try:
             await context.application.bot.edit_message_text(
@@ -838,6 +2025,9 @@ async def notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Неизвестный параметр.")
         return
 
+    if user_id in users_in_chat:
+        invalidate_recipients(users_in_chat[user_id]["room"])
+
     new_kb = build_notify_keyboard(user_id)
     try:
         await query.message.edit_reply_markup(new_kb)
@@ -848,7 +2038,7 @@ async def notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 # ------------------------------------------------------------------------
-# 15) ОБРАБОТКА СООБЩЕНИЙ (текст + фото)
+# 15) ОБРАБОТКА СООБЩЕНИЙ (текст + медиа)
 # ------------------------------------------------------------------------
 async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -856,27 +2046,51 @@ async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("[BOT] Тебя нет в чате. /start, чтобы войти.")
         return
 
+    # Альбом считается одним сообщением: лимит списываем только за первый элемент
+    group_id = update.message.media_group_id
+    if not (group_id and group_id in pending_media_groups):
+        if not await flood_guard(update, user_id):
+            return
+
     nickname = users_in_chat[user_id]["nickname"]
     code = users_in_chat[user_id]["code"]
+    room = users_in_chat[user_id]["room"]
 
-    # Если фото
-    if update.message.photo:
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
+    # Если медиа (фото, видео, голосовое, файл)
+    kind, file_id = extract_media(update.message)
+    if kind:
         caption = update.message.caption if update.message.caption else ""
-        full_caption = f"{code} {nickname} прислал(а) фото"
+        caption = await apply_content_filter(update, context, caption)
+
+        if update.message.media_group_id:
+            # Подпись альбома приходит с одним из элементов — проверяем её здесь; None гасит весь альбом
+            if caption and not await duplicate_guard(update, context, user_id, caption):
+                caption = None
+            buffer_media_group(context.application, user_id, update.message, kind, file_id, caption)
+            update_last_activity(user_id)
+            return
+
+        if caption is None or (caption and not await duplicate_guard(update, context, user_id, caption)):
+            return
+        full_caption = f"{code} {nickname} прислал(а) {MEDIA_LABELS[kind]}"
         if caption:
             full_caption += f"\n{caption}"
 
-        await broadcast_photo(context.application, file_id, caption=full_caption, exclude_user=user_id)
+        await broadcast_media(context.application, kind, file_id, caption=full_caption, exclude_user=user_id,
+                              room=room, sender=user_id)
+        record_history(room, full_caption, (file_id,) if kind == "photo" else (), sender=user_id)
         update_last_activity(user_id)
         return
 
     # Иначе текст
-    text = update.message.text.strip()
+    text = await apply_content_filter(update, context, update.message.text.strip())
+    if text is None or not await duplicate_guard(update, context, user_id, text):
+        return
+
     replied_nick = ""
     if update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.application.bot.id:
         replied_nick = parse_replied_nickname(update.message.reply_to_message.text)
+    reply_to = find_user_by_nickname(replied_nick, room) if replied_nick else None
 
     if text.startswith("%"):
         # Третье лицо
@@ -885,15 +2099,18 @@ async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             final_text = f"{nickname} (reply to {replied_nick}) {out_text}"
         else:
             final_text = f"{nickname} {out_text}"
-        await broadcast_text(context.application, final_text, exclude_user=user_id)
+        await broadcast_text(context.application, final_text, exclude_user=user_id, room=room,
+                             reply_to=reply_to, sender=user_id)
     else:
         # Обычное сообщение
         if replied_nick:
             final_text = f"{nickname} (reply to {replied_nick}): {text}"
         else:
             final_text = f"{nickname}: {text}"
-        await broadcast_text(context.application, final_text, exclude_user=user_id)
+        await broadcast_text(context.application, final_text, exclude_user=user_id, room=room,
+                             reply_to=reply_to, sender=user_id)
 
+    record_history(room, final_text, sender=user_id)
     update_last_activity(user_id)
 
 
@@ -906,10 +2123,14 @@ async def set_bot_commands(telegram_app):
         BotCommand("stop", "Выйти из чата"),
         BotCommand("nick", "Сменить ник"),
         BotCommand("list", "Список пользователей"),
+        BotCommand("last", "Кто недавно вышел"),
+        BotCommand("history", "История чата"),
         BotCommand("msg", "Отправить ЛС"),
         BotCommand("getmsg", "Получить ЛС"),
         BotCommand("hug", "Обнять"),
         BotCommand("search", "Поиск по нику"),
+        BotCommand("ignore", "Игнорировать пользователя"),
+        BotCommand("unignore", "Перестать игнорировать"),
         BotCommand("poll", "Создать опрос"),
         BotCommand("polldone", "Завершить опрос"),
         BotCommand("notify", "Уведомления"),
@@ -922,18 +2143,446 @@ async def set_bot_commands(telegram_app):
 
 async def post_init(telegram_app):
     await set_bot_commands(telegram_app)
+    outbox_startup()
+    outbox["worker"] = asyncio.create_task(outbox_worker(telegram_app))
+    loop_monitor["task"] = asyncio.create_task(loop_lag_monitor())
+
+async def post_shutdown(telegram_app):
+    for task in (outbox["worker"], loop_monitor["task"]):
+        if task is not None:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    outbox["worker"] = loop_monitor["task"] = None
+    outbox_close()
+    close_trace()
 
 
 # ------------------------------------------------------------------------
-# 17) ГЛАВНАЯ ФУНКЦИЯ
+# 16.1) ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА АПДЕЙТОВ
 # ------------------------------------------------------------------------
-def main():
-    # Запускаем Flask (keep-alive) в фоновом потоке
-    keep_alive()
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+# Сколько апдейтов PTB держит «в работе» одновременно, включая ждущих своей очереди у пользователя.
+# Слоты обработчиков (CONCURRENT_UPDATES) занимают только апдейты, дошедшие до головы очереди.
+PENDING_UPDATES = int(os.getenv("PENDING_UPDATES", "4096"))
 
-    # Создаём Telegram-приложение
-    bot_app = ApplicationBuilder().token(BOT_TOKEN).build()
-    logging.info("Бот запускается...")
+update_slots = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+
+class OrderedApplication(Application):
+    """
+    Апдейты разных пользователей обрабатываются параллельно,
+    апдейты одного пользователя — строго по очереди.
+    ConversationHandler'ы у нас per_user (в личке чат = пользователь),
+    поэтому очереди на пользователя им достаточно.
+
+    Семафор PTB (concurrent_updates) берётся до нашего кода, поэтому он выставлен в
+    PENDING_UPDATES, а настоящий лимит — update_slots после блокировки пользователя:
+    иначе флудер занял бы все слоты своими ждущими апдейтами.
+    """
+
+    async def process_update(self, update: object) -> None:
+        if TRACE_FILE and isinstance(update, Update):
+            record_trace(update)
+
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with update_slots:
+                await super().process_update(update)
+            return
+
+        entry = user_update_locks.get(user.id)
+        if entry is None:
+            entry = user_update_locks[user.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            # asyncio.Lock отдаёт доступ в порядке ожидания — порядок апдейтов сохраняется
+            async with entry[0], update_slots:
+                await super().process_update(update)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                user_update_locks.pop(user.id, None)
+
+
+# ------------------------------------------------------------------------
+# 16.2) ПРОФИЛИРОВАНИЕ МЕДЛЕННЫХ ХЕНДЛЕРОВ (включается через окружение)
+# ------------------------------------------------------------------------
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # доля апдейтов под cProfile
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))          # порог «медленного» апдейта, 0 — выкл
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))                 # сколько дампов хранить
+PROFILING_ENABLED = PROFILE_SAMPLE_RATE > 0 or PROFILE_SLOW_MS > 0
+
+UPDATE_TYPES = ("message", "edited_message", "callback_query", "inline_query", "my_chat_member")
+
+# armed — хендлеры, которые были медленными: следующий их вызов профилируем целиком
+profile_state = {"active": False, "armed": set()}
+
+
+def get_update_type(update) -> str:
+    """Тип апдейта для подписи дампа."""
+    for update_type in UPDATE_TYPES:
+        if getattr(update, update_type, None):
+            return update_type
+    return "other"
+
+
+def instrument_handler(handler, wrap):
+    """Обернуть callback хендлера (и вложенных хендлеров ConversationHandler) через wrap."""
+    if isinstance(handler, ConversationHandler):
+        nested = list(handler.entry_points) + list(handler.fallbacks)
+        for state_handlers in handler.states.values():
+            nested.extend(state_handlers)
+        for h in nested:
+            instrument_handler(h, wrap)
+        return
+    handler.callback = wrap(handler.callback)
+
+
+def instrument_application(bot_app, wrap):
+    """Обернуть все зарегистрированные хендлеры приложения."""
+    for group_handlers in bot_app.handlers.values():
+        for handler in group_handlers:
+            instrument_handler(handler, wrap)
+
+
+def dump_profile(profiler, name: str, update, elapsed_ms: float):
+    """Сохранить дамп и удалить самые старые сверх PROFILE_KEEP."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+    filename = f"{stamp}_{name}_{get_update_type(update)}_{len(users_in_chat)}u_{elapsed_ms:.0f}ms.prof"
+    profiler.dump_stats(os.path.join(PROFILE_DIR, filename))
+    logging.info(f"Профиль {name}: {elapsed_ms:.1f} мс, сохранён в {filename}.")
+
+    dumps = sorted(f for f in os.listdir(PROFILE_DIR) if f.endswith(".prof"))
+    for old in dumps[:-PROFILE_KEEP]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except OSError:
+            pass
+
+
+def profiled(callback):
+    """
+    Обёртка хендлера: случайная доля вызовов идёт под cProfile,
+    медленный вызов логируется и «взводит» профилирование следующего.
+    Профиль снимается со всего потока — параллельные апдейты тоже попадут в дамп.
+    """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        profiler = None
+        if not profile_state["active"] and (
+            name in profile_state["armed"] or random.random() < PROFILE_SAMPLE_RATE
+        ):
+            profile_state["armed"].discard(name)
+            profile_state["active"] = True
+            profiler = cProfile.Profile()
+            profiler.enable()
+
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if profiler is not None:
+                profiler.disable()
+                profile_state["active"] = False
+                dump_profile(profiler, name, update, elapsed_ms)
+            elif PROFILE_SLOW_MS and elapsed_ms >= PROFILE_SLOW_MS:
+                profile_state["armed"].add(name)
+                logging.warning(
+                    f"Медленный хендлер {name}: {elapsed_ms:.0f} мс "
+                    f"({get_update_type(update)}, в чате {len(users_in_chat)})."
+                )
+
+    return wrapper
+
+
+# ------------------------------------------------------------------------
+# 16.3) HTTP-ТРАНСПОРТ ДЛЯ BOT API
+# ------------------------------------------------------------------------
+def transport_profile(prefix: str, pool_size: int, read_timeout: float) -> dict:
+    """Профиль транспорта из переменных окружения {prefix}POOL_SIZE, {prefix}READ_TIMEOUT и т.д."""
+    return {
+        "pool_size": int(os.getenv(f"{prefix}POOL_SIZE", str(pool_size))),
+        "keepalive": int(os.getenv(f"{prefix}KEEPALIVE", str(pool_size))),  # простаивающих соединений
+        "keepalive_expiry": float(os.getenv(f"{prefix}KEEPALIVE_EXPIRY", "30")),
+        "connect_timeout": float(os.getenv(f"{prefix}CONNECT_TIMEOUT", "5")),
+        "read_timeout": float(os.getenv(f"{prefix}READ_TIMEOUT", str(read_timeout))),
+        "write_timeout": float(os.getenv(f"{prefix}WRITE_TIMEOUT", "10")),
+        "pool_timeout": float(os.getenv(f"{prefix}POOL_TIMEOUT", "5")),
+        "http_version": os.getenv(f"{prefix}HTTP_VERSION", "1.1"),  # "2" — нужен python-telegram-bot[http2]
+    }
+
+# Рассылки идут параллельно — пул побольше; getUpdates всегда один запрос
+TRANSPORT = transport_profile("HTTP_", pool_size=64, read_timeout=10)
+GET_UPDATES_TRANSPORT = transport_profile("GET_UPDATES_HTTP_", pool_size=1, read_timeout=10)
+
+
+class TunedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest с настраиваемым keep-alive (в PTB число keep-alive соединений = размер пула)."""
+
+    def __init__(self, keepalive: int, keepalive_expiry: float, **kwargs):
+        self._keepalive = keepalive
+        self._keepalive_expiry = keepalive_expiry
+        super().__init__(**kwargs)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        limits = self._client_kwargs["limits"]
+        self._client_kwargs["limits"] = httpx.Limits(
+            max_connections=limits.max_connections,
+            max_keepalive_connections=min(self._keepalive, limits.max_connections),
+            keepalive_expiry=self._keepalive_expiry,
+        )
+        return super()._build_client()
+
+    async def do_request(self, url: str, *args, **kwargs):
+        """Считаем запросы «в полёте» и время ответа Bot API (long polling getUpdates — не считаем)."""
+        if url.endswith("/getUpdates"):
+            return await super().do_request(url, *args, **kwargs)
+        api_stats["in_flight"] += 1
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, *args, **kwargs)
+        finally:
+            api_stats["in_flight"] -= 1
+            api_stats["rtt"].append(time.perf_counter() - started)
+
+
+def build_request(profile: dict) -> HTTPXRequest:
+    """Собрать HTTP-клиент по профилю; без h2 откатываемся на HTTP/1.1."""
+    kwargs = dict(
+        keepalive=profile["keepalive"],
+        keepalive_expiry=profile["keepalive_expiry"],
+        connection_pool_size=profile["pool_size"],
+        connect_timeout=profile["connect_timeout"],
+        read_timeout=profile["read_timeout"],
+        write_timeout=profile["write_timeout"],
+        pool_timeout=profile["pool_timeout"],
+        http_version=profile["http_version"],
+    )
+    try:
+        return TunedHTTPXRequest(**kwargs)
+    except RuntimeError as e:
+        if profile["http_version"] != "2":
+            raise
+        logging.warning(f"HTTP/2 недоступен ({e}), используем HTTP/1.1.")
+        kwargs["http_version"] = "1.1"
+        return TunedHTTPXRequest(**kwargs)
+
+
+# ------------------------------------------------------------------------
+# 16.4) ЗАПИСЬ ТРАССЫ АПДЕЙТОВ (для replay_trace.py)
+# ------------------------------------------------------------------------
+# TRACE_FILE=trace.jsonl.gz — писать анонимизированные апдейты.
+# Каждый запуск пишет свой файл (trace-20240101-120000.jsonl.gz): псевдо-id и отсчёт t
+# живут только в памяти процесса, склеивать запуски в один файл нельзя.
+# Строка файла: {"t": секунды от начала записи, "u": урезанный Update.to_dict()}.
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+TRACE_FLUSH_EVERY = 100
+TRACE_BOT_ID = 1  # все боты (в т.ч. наш, в reply_to_message) — один id; его же отдаёт getMe в replay_trace.py
+
+# Что оставляем от апдейта: только поля, которые читают наши хендлеры
+TRACE_KEYS = {
+    "update": {"update_id", "message", "callback_query"},
+    "message": {
+        "message_id", "date", "chat", "from", "text", "caption", "entities", "caption_entities",
+        "photo", "video", "voice", "document", "media_group_id", "reply_to_message",
+    },
+    "callback_query": {"id", "from", "chat_instance", "data", "message"},
+    "user": {"id", "is_bot", "first_name"},
+    "entity": {"type", "offset", "length", "user"},  # url у text_link не пишем
+    "chat": {"id", "type"},
+    "file": {"file_id", "file_unique_id", "width", "height", "duration"},
+}
+
+trace_state = {"file": None, "started": None, "count": 0, "ids": {}}
+
+
+def anon_id(real_id: int) -> int:
+    """Стабильный в пределах записи псевдо-id (соответствие в файл не пишется)."""
+    ids = trace_state["ids"]
+    if real_id not in ids:
+        ids[real_id] = 100000 + len(ids)
+    return ids[real_id]
+
+
+def anon_text(text: str) -> str:
+    """
+    Буквы -> «а»/«a», цифры -> 0, остальное как есть.
+    Длина и раскладка сохраняются, поэтому смещения entities остаются верными.
+    Команда в начале строки (/start, /msg) сохраняется.
+    """
+    command = ""
+    if text.startswith("/"):
+        command, _, text = text.partition(" ")
+        command += " " if text else ""
+    out = []
+    for ch in text:
+        if ch.isdigit():
+            out.append("0")
+        elif ch.isalpha() and ord(ch) < 0x10000:
+            out.append("а" if "\u0400" <= ch <= "\u04ff" else "a")
+        else:
+            out.append(ch)
+    return command + "".join(out)
+
+
+def anon_callback_data(data: str) -> str:
+    """В callback_data (msg_select|<user_id>, pollvote|<creator_id>|N) подменяем id."""
+    parts = data.split("|")
+    return "|".join(str(anon_id(int(p))) if p.isdigit() and len(p) >= 6 else p for p in parts)
+
+
+def scrub(obj: dict, kind: str) -> dict:
+    """Урезать и обезличить часть апдейта вида kind."""
+    out = {}
+    for key, value in obj.items():
+        if key not in TRACE_KEYS[kind]:
+            continue
+        if key in ("message", "reply_to_message"):
+            out[key] = scrub(value, "message")
+        elif key == "callback_query":
+            out[key] = scrub(value, "callback_query")
+        elif key in ("from", "user"):
+            out[key] = scrub(value, "user")
+        elif key in ("entities", "caption_entities"):
+            out[key] = [scrub(entity, "entity") for entity in value]
+        elif key == "id" and kind == "user" and obj.get("is_bot"):
+            out[key] = TRACE_BOT_ID
+        elif key == "chat":
+            out[key] = scrub(value, "chat")
+        elif key in ("photo",):
+            out[key] = [scrub(size, "file") for size in value]
+        elif key in ("video", "voice", "document"):
+            out[key] = scrub(value, "file")
+        elif key == "id" and kind in ("user", "chat"):
+            out[key] = anon_id(value)
+        elif key in ("file_id", "file_unique_id"):
+            out[key] = "f" + hashlib.sha1(value.encode()).hexdigest()[:16]
+        elif key == "first_name":
+            out[key] = "u"
+        elif key in ("text", "caption"):
+            out[key] = anon_text(value)
+        elif key == "data":
+            out[key] = anon_callback_data(value)
+        else:
+            out[key] = value
+    return out
+
+
+def record_trace(update: Update):
+    """Дописать апдейт в трассу."""
+    if trace_state["file"] is None:
+        head, tail = os.path.split(TRACE_FILE)
+        name, dot, ext = tail.partition(".")
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(head, f"{name}-{stamp}{dot}{ext}")
+        trace_state["file"] = gzip.open(path, "wt", encoding="utf-8")
+        trace_state["started"] = time.monotonic()
+        logging.info(f"Запись трассы апдейтов в {path}.")
+    try:
+        record = {
+            "t": round(time.monotonic() - trace_state["started"], 3),
+            "u": scrub(update.to_dict(), "update"),
+        }
+        trace_state["file"].write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+    except Exception as e:
+        logging.warning(f"Не смог записать апдейт в трассу: {e}")
+        return
+    trace_state["count"] += 1
+    if trace_state["count"] % TRACE_FLUSH_EVERY == 0:
+        trace_state["file"].flush()
+
+
+def close_trace():
+    """Закрыть файл трассы (gzip дописывает хвост только при закрытии)."""
+    if trace_state["file"] is not None:
+        trace_state["file"].close()
+        trace_state["file"] = None
+
+
+# ------------------------------------------------------------------------
+# 16.5) ДИАГНОСТИКА: ЛАГ EVENT LOOP И ЗАДЕРЖКА BOT API (/ping для админов)
+# ------------------------------------------------------------------------
+LOOP_LAG_INTERVAL = 0.5        # сек между замерами
+LOOP_LAG_SAMPLES = 600         # ~5 минут истории
+API_RTT_SAMPLES = 500
+LOOP_LAG_SLOW = 0.1            # p95 лага больше — тормозят наши хендлеры
+API_RTT_SLOW = 1.0             # p95 ответа API больше — тормозит Telegram
+
+loop_monitor = {"lag": deque(maxlen=LOOP_LAG_SAMPLES), "task": None}
+api_stats = {"in_flight": 0, "rtt": deque(maxlen=API_RTT_SAMPLES)}
+
+
+async def loop_lag_monitor():
+    """Насколько позже заказанного просыпается sleep — столько event loop был занят чужим кодом."""
+    lag = loop_monitor["lag"]
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag.append(max(0.0, time.perf_counter() - started - LOOP_LAG_INTERVAL))
+
+
+def percentiles(values, qs=(0.5, 0.95, 0.99)) -> list:
+    """Перцентили по выборке (пустая — нули)."""
+    ordered = sorted(values)
+    if not ordered:
+        return [0.0 for _ in qs]
+    return [ordered[min(len(ordered) - 1, int(len(ordered) * q))] for q in qs]
+
+
+def diagnostics_report() -> str:
+    """Текст подробного /ping."""
+    lag = loop_monitor["lag"]
+    rtt = api_stats["rtt"]
+    lag_p50, lag_p95, lag_p99 = percentiles(lag)
+    rtt_p50, rtt_p95, rtt_p99 = percentiles(rtt)
+    outbox_pending = get_outbox_db().execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+    if lag_p95 > LOOP_LAG_SLOW:
+        verdict = "event loop занят — тормозят наши хендлеры"
+    elif rtt_p95 > API_RTT_SLOW:
+        verdict = "медленно отвечает Telegram"
+    else:
+        verdict = "всё в норме"
+
+    return (
+        "Pong!\n"
+        f"Лаг event loop, мс (замеров {len(lag)}): p50 {lag_p50 * 1000:.1f}, "
+        f"p95 {lag_p95 * 1000:.1f}, p99 {lag_p99 * 1000:.1f}, макс {max(lag, default=0) * 1000:.1f}\n"
+        f"Ответ Bot API с ожиданием пула, мс (запросов {len(rtt)}): p50 {rtt_p50 * 1000:.0f}, "
+        f"p95 {rtt_p95 * 1000:.0f}, p99 {rtt_p99 * 1000:.0f}\n"
+        f"Запросов в полёте: {api_stats['in_flight']}\n"
+        f"Очередь outbox: {outbox_pending}, альбомов в сборке: {len(pending_media_groups)}, "
+        f"входов/выходов в ожидании: {len(pending_presence)}\n"
+        f"В чате: {len(users_in_chat)}, комнат: {len(rooms)}\n"
+        f"Вывод: {verdict}"
+    )
+
+
+# ------------------------------------------------------------------------
+# 17) ГЛАВНАЯ ФУНКЦИЯ
+# ------------------------------------------------------------------------
+def build_application(request=None, get_updates_request=None):
+    """
+    Собрать Telegram-приложение со всеми хендлерами.
+    request/get_updates_request — свой транспорт (например, заглушка в replay_trace.py).
+    """
+    bot_app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .application_class(OrderedApplication)
+        .concurrent_updates(max(PENDING_UPDATES, CONCURRENT_UPDATES))
+        .request(request or build_request(TRANSPORT))
+        .get_updates_request(get_updates_request or build_request(GET_UPDATES_TRANSPORT))
+        .build()
+    )
 
     # 1) Conversation /nick
     nick_conv_handler = ConversationHandler(
@@ -988,6 +2637,8 @@ def main():
 
     bot_app.add_handler(nick_conv_handler)
     bot_app.add_handler(CommandHandler("list", list_users))
+    bot_app.add_handler(CommandHandler("last", last_command))
+    bot_app.add_handler(CommandHandler("history", history_command))
     bot_app.add_handler(CommandHandler("help", help_command))
     bot_app.add_handler(CommandHandler("rules", rules))
     bot_app.add_handler(CommandHandler("about", about))
@@ -998,6 +2649,8 @@ def main():
 
     bot_app.add_handler(hug_conv_handler)
     bot_app.add_handler(CommandHandler("search", search_command))
+    bot_app.add_handler(CommandHandler("ignore", ignore_command))
+    bot_app.add_handler(CommandHandler("unignore", unignore_command))
 
     bot_app.add_handler(poll_conv_handler)
     bot_app.add_handler(CommandHandler("polldone", poll_done))
@@ -1007,11 +2660,30 @@ def main():
 
     bot_app.add_handler(CallbackQueryHandler(poll_vote_callback, pattern="^pollvote\\|"))
 
-    # Обработка сообщений (текст/фото)
-    bot_app.add_handler(MessageHandler(~filters.COMMAND & (filters.TEXT | filters.PHOTO), anonymous_message))
+    # Обработка сообщений (текст/медиа)
+    bot_app.add_handler(MessageHandler(
+        ~filters.COMMAND & (filters.TEXT | filters.PHOTO | filters.VIDEO | filters.VOICE | filters.Document.ALL),
+        anonymous_message
+    ))
+
+    # Профилирование: без PROFILE_* хендлеры не оборачиваются вовсе
+    if PROFILING_ENABLED:
+        instrument_application(bot_app, profiled)
+        logging.info(f"Профилирование включено: sample={PROFILE_SAMPLE_RATE}, slow={PROFILE_SLOW_MS} мс.")
 
     # post_init для установки /команд
     bot_app.post_init = post_init
+    bot_app.post_shutdown = post_shutdown
+    return bot_app
+
+
+def main():
+    # Запускаем Flask (keep-alive) в фоновом потоке
+    keep_alive()
+
+    # Создаём Telegram-приложение
+    bot_app = build_application()
+    logging.info("Бот запускается...")
 
     # Запуск
     bot_app.run_polling()
@@ -0,0 +1,159 @@
+"""
+Прогон записанной трассы апдейтов (TRACE_FILE) через хендлеры main.py.
+
+Бот подменяется заглушкой транспорта: запросы к Bot API никуда не уходят,
+а только считаются по методам. В конце печатается время каждого хендлера
+и число исходящих вызовов — для сравнения изменений на реальной форме трафика.
+
+Запуск:
+    python replay_trace.py trace.jsonl.gz [--realtime] [--keep-limits]
+"""
+import os
+import json
+import gzip
+import time
+import asyncio
+import argparse
+import functools
+
+from collections import Counter, defaultdict
+
+os.environ.setdefault("token_on", "123456:REPLAY")
+os.environ.setdefault("OUTBOX_DB", ":memory:")
+os.environ["TRACE_FILE"] = ""  # прогон не должен писать новую трассу
+
+import main  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+BOT_USER = {"id": main.TRACE_BOT_ID, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+
+
+class StubRequest(BaseRequest):
+    """Транспорт-заглушка: отвечает на любой метод Bot API правдоподобным результатом."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.message_id = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, text=None):
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            "from": BOT_USER,
+        }
+        if text is not None:
+            message["text"] = text
+        return message
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method == "sendMediaGroup":
+            result = [self._message(params.get("chat_id")) for _ in params.get("media", [])]
+        elif api_method.startswith("send") or api_method.startswith("edit"):
+            result = self._message(params.get("chat_id"), params.get("text"))
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+def read_trace(path: str):
+    """Записи трассы: (t, update_dict)."""
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record["t"], record["u"]
+
+
+def timed(callback, timings: dict):
+    """Обёртка хендлера: копит длительность каждого вызова в timings[имя]."""
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            timings[name].append((time.perf_counter() - started) * 1000)
+
+    return wrapper
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+
+async def replay(path: str, realtime: bool):
+    request = StubRequest()
+    bot_app = main.build_application(request=request, get_updates_request=StubRequest())
+    timings = defaultdict(list)
+    main.instrument_application(bot_app, lambda callback: timed(callback, timings))
+
+    count = 0
+    async with bot_app:
+        await bot_app.start()
+        started = time.perf_counter()
+        for t, data in read_trace(path):
+            if realtime:
+                delay = t - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await bot_app.process_update(Update.de_json(data, bot_app.bot))
+            count += 1
+        elapsed = time.perf_counter() - started
+
+        # Дожидаемся отложенных рассылок: альбомов и сводок входов/выходов
+        await asyncio.sleep(max(main.MEDIA_GROUP_WINDOW, main.PRESENCE_WINDOW) + 0.2)
+        await bot_app.stop()
+
+    print(f"Апдейтов: {count}, за {elapsed:.2f} с")
+    print(f"\n{'хендлер':<32} {'вызовов':>8} {'всего, мс':>10} {'p50':>8} {'p95':>8} {'макс':>8}")
+    for name, values in sorted(timings.items(), key=lambda item: -sum(item[1])):
+        print(
+            f"{name:<32} {len(values):>8} {sum(values):>10.1f} "
+            f"{percentile(values, 0.5):>8.2f} {percentile(values, 0.95):>8.2f} {max(values):>8.2f}"
+        )
+
+    request.calls["getMe"] -= 1  # служебный вызов при initialize()
+    print(f"\n{'метод Bot API':<32} {'вызовов':>8}")
+    for api_method, calls in request.calls.most_common():
+        if calls:
+            print(f"{api_method:<32} {calls:>8}")
+
+
+def main_replay():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="файл трассы (TRACE_FILE)")
+    parser.add_argument("--realtime", action="store_true", help="сохранять паузы между апдейтами")
+    parser.add_argument("--keep-limits", action="store_true", help="не отключать антифлуд при ускоренном прогоне")
+    args = parser.parse_args()
+
+    # В ускоренном прогоне все сообщения «слиплись» бы и упёрлись в антифлуд
+    if not args.realtime and not args.keep_limits:
+        for role in main.RATE_LIMITS:
+            main.RATE_LIMITS[role] = (float("inf"), float("inf"))
+    # После обезличивания тексты одной длины совпадают буква в букву — детектор повторов отключаем
+    main.DUP_MIN_LENGTH = float("inf")
+
+    asyncio.run(replay(args.trace, args.realtime))
+
+
+if __name__ == "__main__":
+    main_replay()